@@ -2,8 +2,10 @@ import os
 import psycopg2
 import re
 import readline
+import threading
 import time
 import traceback
+from collections import Counter
 from configparser import ConfigParser
 from enum import IntEnum
 from datetime import datetime, timedelta
@@ -13,11 +15,24 @@ _CONFIG_FILE_PATH = 'B:\\\\Projects\\journal_writer'
 _CONFIG_FILE_NAME = 'config.ini'
 _CONFIG_FILE = os.path.join(os.getcwd(), f'{_CONFIG_FILE_PATH}/{_CONFIG_FILE_NAME}')
 _CONFIG_SECTION = 'postgresql'
+# Journal text is appended here while writing, so a crash doesn't lose it
+_DRAFT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal_draft.txt')
+# fsync the draft after this many chunks, or this many seconds after the first unsynced chunk
+DRAFT_FSYNC_EVERY = 5
+DRAFT_FSYNC_SECONDS = 3
+# How much of the written text to show in the prompt while continuing the journal
+JOURNAL_PROMPT_TAIL = 80
 # TODO encrypt the journal text
 # Store the journal text globally, just in case it gets lost
 journal = ''
 # Table names for auto complete
 table_names = []
+# In-memory BK-tree of entertainment names for typo tolerant search, built on first use
+entertainment_index = None
+# Max edit distance for fuzzy entertainment matches, shorter names get less
+FUZZY_MAX_DISTANCE = 3
+# Roman numerals up to 39, enough for sequels without matching words like 'mix' or 'civil'
+ROMAN_NUMERAL_REGEX = r'x{0,3}(ix|iv|v?i{0,3})'
 
 # TV show duration regex pattern --> S1E10-S1E13
 TV_SERIES_REGEX_PATTERN = r'S([1-9]\d*)E([1-9]\d*)-S([1-9]\d*)E([1-9]\d*)'
@@ -117,17 +132,281 @@ def query(conn, sql: str, values: tuple = None, fetch: bool = True, add_header:
             return results
     except psycopg2.OperationalError:
         # Try again with new conn, got lots of connection errors lately
-        count += 1
-        if count <= times:
-            print(f'Trying again... #{count}')
-            query(connect(config), sql, values, fetch, add_header, count)
-        else:
-            print(f'Tried {times} times, stopped')
+        if times > 0:
+            print(f'Trying again... ({times} left)')
+            return query(connect(config), sql, values, fetch, add_header, times - 1)
+        traceback.print_exc()
+        if yes_no_question('Try again with a new connection?'):
+            return query(connect(config), sql, values, fetch, add_header)
+        return None
     except Exception:
         traceback.print_exc()
         # Maybe it works this time
         if yes_no_question('Try again with a new connection?'):
-            query(connect(config), sql, values, fetch, add_header)
+            return query(connect(config), sql, values, fetch, add_header)
+        return None
+
+# --- JOURNAL DRAFT --------------------------------------------
+
+class DraftLog:
+    """
+    Append-only log of the journal chunks, one chunk per line.
+    Every append is flushed to the OS (survives the app crashing). fsync (survives the machine crashing)
+    runs every DRAFT_FSYNC_EVERY chunks, on close, or by a timer DRAFT_FSYNC_SECONDS after the first unsynced chunk.
+    """
+    def __init__(self, path: str = _DRAFT_FILE):
+        self.path = path
+        self.file = None
+        self.pending = 0
+        self.timer = None
+        # Timer thread syncs while the main thread may be writing
+        self.lock = threading.Lock()
+
+    def read(self) -> str:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                # input() never returns new lines, so they are only chunk separators
+                return ''.join(line.rstrip('\n') for line in f)
+        except FileNotFoundError:
+            return ''
+
+    def append(self, chunk: str):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(chunk + '\n')
+            self.file.flush()
+            self.pending += 1
+            if self.pending >= DRAFT_FSYNC_EVERY:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(DRAFT_FSYNC_SECONDS, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.file is not None and self.pending:
+            os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def reset(self):
+        self.close()
+        open(self.path, 'w', encoding='utf-8').close()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def backup(self) -> str:
+        # Keeps the old draft aside (replacing the older backup) instead of deleting it
+        self.close()
+        backup_path = self.path + '.bak'
+        os.replace(self.path, backup_path)
+        return backup_path
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+# --- FUZZY SEARCH ---------------------------------------------
+
+def levenshtein(a: str, b: str, limit: int = None) -> int:
+    """
+    Edit distance (insert/delete/substitute) between two strings.
+    With a limit, stops early and returns limit + 1 once the distance is known to be bigger.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ca != cb)
+            ))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def fuzzy_distance_limit(name: str) -> int:
+    # Allow ~1 typo per 4 chars, names shorter than that must match exactly ('the' would match every 'The ...')
+    return min(FUZZY_MAX_DISTANCE, len(name) // 4)
+
+def name_words(name: str) -> list[str]:
+    return re.findall(r'\w+', name.lower())
+
+def name_numbers(name: str) -> tuple[str, ...]:
+    # Sequels only differ by these: 'Toy Story 2', 'Rocky IV'
+    return tuple(t for t in re.findall(r'[a-z]+|\d+', name.lower()) if t.isdigit() or re.fullmatch(ROMAN_NUMERAL_REGEX, t))
+
+class BKTree:
+    """
+    Burkhard-Keller tree keyed by lower-cased names, each node keeps every row with that name.
+    Searches only visit children whose edge distance is within the triangle inequality bounds,
+    so a lookup touches a small part of the tree instead of every name.
+    """
+    def __init__(self):
+        # Node: [key, rows, {distance: child node}]
+        self.root = None
+        # Same words repeat a lot, skip walking the tree for the known ones
+        self.nodes = {}
+
+    def add(self, name: str, row: tuple):
+        key = name.lower()
+        if key in self.nodes:
+            self.nodes[key][1].append(row)
+            return
+        new_node = [key, [row], {}]
+        self.nodes[key] = new_node
+        if self.root is None:
+            self.root = new_node
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(key, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = new_node
+                return
+            node = child
+
+    def search(self, name: str, max_distance: int) -> list[tuple[int, tuple]]:
+        """
+        Returns (distance, row) pairs within max_distance, closest first, each row (by ID) once
+        """
+        key = name.lower()
+        found = {}
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            # Beyond this, neither the node nor any of its children can match
+            limit = max_distance + max(node[2], default=0)
+            distance = levenshtein(key, node[0], limit)
+            if distance <= max_distance:
+                for row in node[1]:
+                    if row[0] not in found or distance < found[row[0]][0]:
+                        found[row[0]] = (distance, row)
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found.values(), key=lambda x: (x[0], x[1][1]))
+
+def load_entertainments(conn) -> list[tuple] | None:
+    rows = query(conn, 'SELECT id, name, type FROM entertainments')
+    if rows is None:
+        print('[WARNING] Could not load the entertainments, fuzzy search is not available')
+        return None
+    return [tuple(row) for row in rows]
+
+def add_to_entertainment_index(index: BKTree, row: tuple):
+    # Words of the name are the keys, so a partial name can match like ILIKE '%name%' would
+    for word in set(name_words(row[1])):
+        index.add(word, row)
+
+def get_entertainment_index(conn) -> BKTree | None:
+    # Built once, insert_entertainment keeps it up to date, custom_query/option 10 drop it after changes
+    global entertainment_index
+    if entertainment_index is None:
+        rows = load_entertainments(conn)
+        # Don't cache a failed load, try again on the next lookup
+        if rows is None:
+            return None
+        index = BKTree()
+        for row in rows:
+            add_to_entertainment_index(index, row)
+        entertainment_index = index
+    return entertainment_index
+
+def fuzzy_search_entertainments(conn, name: str) -> list[tuple]:
+    """
+    Rows whose name has a close match for every word of the given name, ranked by the total distance
+    """
+    index = get_entertainment_index(conn)
+    words = set(name_words(name))
+    if index is None or not words:
+        return []
+    matches = None
+    for word in words:
+        found = {row[0]: (distance, row) for distance, row in index.search(word, fuzzy_distance_limit(word))}
+        if matches is None:
+            matches = found
+        else:
+            matches = {e_id: (matches[e_id][0] + found[e_id][0], found[e_id][1]) for e_id in matches if e_id in found}
+        if not matches:
+            return []
+    return [row for _, row in sorted(matches.values(), key=lambda x: (x[0], x[1][1]))]
+
+def trigrams(name: str) -> set[str]:
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+def find_duplicate_entertainments(conn):
+    """
+    Lists pairs of near-identical entertainment names of the same type.
+    Names with different numbers (sequels) are not duplicates, close matches aren't chained into clusters.
+    Instead of comparing every pair, candidates come from a trigram index: each edit breaks at most 3 trigrams,
+    so a name within k edits shares at least len(trigrams) - 3k of them. Names too short for that
+    are only compared with the same length (+-k) ones. Candidates are then checked with levenshtein.
+    """
+    global entertainment_index
+    # Always start fresh, duplicates may have been fixed with a custom query
+    rows = load_entertainments(conn)
+    if rows is None:
+        return
+    # Search index is rebuilt on the next lookup with the same fresh data
+    entertainment_index = None
+
+    names = [row[1].lower() for row in rows]
+    # Only names of the same type and numbers can be duplicates
+    groups = [(row[2], name_numbers(row[1])) for row in rows]
+    grams = [trigrams(name) for name in names]
+    by_gram = {}
+    by_length = {}
+    for i, name in enumerate(names):
+        for gram in grams[i]:
+            by_gram.setdefault((groups[i], gram), []).append(i)
+        by_length.setdefault((groups[i], len(name)), []).append(i)
+
+    pairs = []
+    for i, name in enumerate(names):
+        limit = fuzzy_distance_limit(name)
+        needed = len(grams[i]) - 3 * limit
+        # Each pair once, from the first of the two
+        if needed > 0:
+            shared = Counter(j for gram in grams[i] for j in by_gram[(groups[i], gram)] if j > i)
+            candidates = [j for j, count in shared.items() if count >= needed]
+        else:
+            candidates = [j for length in range(len(name) - limit, len(name) + limit + 1)
+                          for j in by_length.get((groups[i], length), []) if j > i]
+        for j in candidates:
+            distance = levenshtein(name, names[j], limit)
+            if distance <= limit:
+                pairs.append((distance, rows[i], rows[j]))
+
+    if not pairs:
+        print('No duplicate entertainments found')
+        return
+    print_rows = [('Distance', 'Entertainment Name', 'ID', 'Duplicate Name', 'Duplicate ID', 'Type')]
+    for distance, row, other in sorted(pairs, key=lambda x: (x[0], x[1][1])):
+        print_rows.append((distance, row[1], row[0], other[1], other[0], row[2]))
+    print_query_table(print_rows)
 
 # --- DB QUERY FUNCTIONS ---------------------------------------
 
@@ -148,6 +427,8 @@ def insert_entertainment(conn) -> tuple[str, int]:
     if inserted and len(inserted) > 0:
         e_id, e_name, e_type = inserted[0]
         print(f'Inserted: {e_name} ({e_id})')
+        if entertainment_index is not None:
+            add_to_entertainment_index(entertainment_index, (e_id, e_name, e_type))
         return e_id, e_type
     else:
         print(f'Failed to insert {name}')
@@ -159,8 +440,12 @@ def get_entertainment(conn, just_show: bool = False) -> tuple[str, int]:
     values = (f'%{name}%', )
     entertainments = query(conn, sql, values=values)
     if not entertainments or len(entertainments) == 0:
-        print('Could not find any entertainments with that name')
-        return None, None
+        # Maybe it's a typo, try the closest names
+        entertainments = fuzzy_search_entertainments(conn, name)
+        if not entertainments:
+            print('Could not find any entertainments with that name')
+            return None, None
+        print('Could not find an exact match, did you mean:')
 
     # Print option and return the selected ones ID
     print('0- Nope/Exit')
@@ -255,6 +540,7 @@ def add_daily_entertainments() -> list[tuple[str, str, str]]:
     return daily_entertainments
 
 def insert_gunluk(conn, is_custom_date = False):
+    global journal
     print(tabulate([(e.name, e.value) for e in Happiness], tablefmt="rounded_outline"))
 
     # Ewww!
@@ -277,20 +563,39 @@ def insert_gunluk(conn, is_custom_date = False):
         else:
             break
 
-    _temp_journal = ''
+    draft = DraftLog()
+    _temp_journal = draft.read()
     _journal_input_msg = 'Journal: '
-    while True:
-        # TODO encyrpt the journal text!!!
-        _temp_journal += input(_journal_input_msg)
-        # Ask if it's completed or accidently pressed the Enter button
-        if yes_no_question('Is it done?'):
+    if _temp_journal:
+        print(f'Recovered draft:\n{_temp_journal}')
+        while True:
+            if yes_no_question('Continue the recovered draft?'):
+                _journal_input_msg = 'Journal: ...' + _temp_journal[-JOURNAL_PROMPT_TAIL:]
+                break
+            elif yes_no_question('Discard the recovered draft?'):
+                print(f'Old draft is moved to {draft.backup()}')
+                _temp_journal = ''
+                break
+    try:
+        while True:
+            # TODO encyrpt the journal text!!!
+            _chunk = input(_journal_input_msg)
+            draft.append(_chunk)
+            _temp_journal += _chunk
             journal = _temp_journal
-            break
-        elif yes_no_question('Reset the written text?'):
-            _temp_journal = ''
-        else:
-            # Add the last entry to the input msg, so I can continue writing it seamlessly
-            _journal_input_msg = 'Journal: ' + _temp_journal
+            # Ask if it's completed or accidently pressed the Enter button
+            if yes_no_question('Is it done?'):
+                break
+            elif yes_no_question('Reset the written text?'):
+                draft.reset()
+                _temp_journal = ''
+                journal = ''
+                _journal_input_msg = 'Journal: '
+            else:
+                # Only show the end of the text, so I can continue writing it seamlessly without echoing all of it
+                _journal_input_msg = 'Journal: ...' + _temp_journal[-JOURNAL_PROMPT_TAIL:]
+    finally:
+        draft.close()
 
     # Get daily entertainments
     daily_entertainments = add_daily_entertainments()
@@ -363,6 +668,7 @@ def insert_gunluk(conn, is_custom_date = False):
         INSERT INTO daily_entertainments
         (journal_id, entertainment_id, duration)
         VALUES {placeholders}
+        RETURNING journal_id
         """
 
         # Flatten the daily_entertainments list to pass as values to the execute method
@@ -373,7 +679,12 @@ def insert_gunluk(conn, is_custom_date = False):
         sql = journal_sql
         values = journal_values
 
-    query(conn, sql, values=values, fetch=False)
+    inserted = query(conn, sql, values=values)
+    # Keep the draft until it's really in the DB
+    if inserted:
+        draft.discard()
+    else:
+        print(f'[WARNING] Journal is not inserted, the draft is kept in {draft.path}')
 
 def show_last_10(conn):
     sql = """
@@ -563,7 +874,7 @@ def typed_input(msg: str, types: list[type]):
 
 def custom_query(conn):
     # Get all table names for auto complete
-    global table_names
+    global table_names, entertainment_index
     if not table_names:
         table_sql = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public';"
         table_names = query(conn, table_sql)
@@ -601,6 +912,10 @@ def custom_query(conn):
     if sql[-1] != ';':
         sql += ';'
 
+    # Fuzzy search index would be stale after changing the entertainments
+    if any(x in sql.upper() for x in ['INSERT', 'UPDATE', 'DELETE', 'TRUNCATE']) and re.search(r'\bentertainments\b', sql, re.IGNORECASE):
+        entertainment_index = None
+
     r = query(conn, sql, add_header=True)
     if r:
         # Only 1 column, ask the text cut length
@@ -621,6 +936,10 @@ if __name__ == '__main__':
     print('Starting...')
     config = load_config()
     print('Configs loadded')
+    # Recover the journal text if the last session crashed while writing it
+    journal = DraftLog().read()
+    if journal:
+        print('[WARNING] Recovered an unsaved journal draft, see option 8')
     sleep_period = 2
     while True:
         conn = connect(config)
@@ -649,6 +968,7 @@ if __name__ == '__main__':
                 (7, 'Move last entertainment to today'),
                 (8, 'Show journal text'),
                 (9, 'Find daily entertainment'),
+                (10, 'Find duplicate entertainments'),
                 ], tablefmt="rounded_outline"))
             option = typed_input('--> ', [int])
 
@@ -675,8 +995,10 @@ if __name__ == '__main__':
                     print(journal)
                 case 9:
                     get_daily_entertainment(conn, just_show=True)
+                case 10:
+                    find_duplicate_entertainments(conn)
                 case _:
-                    print('[ERROR] Invalid input number (0-8)')
+                    print('[ERROR] Invalid input number (0-10)')
         except Exception as e:
             print(e)
 